@@ -8,30 +8,103 @@ import os
 import warnings
 import pdb
 
-from scipy import integrate
-from scipy.interpolate import interp1d
-
 from astropy import units as u
 from astropy.modeling import FittableModel, Parameter
 from astropy.modeling import fitting
 
+from pkg_resources import resource_filename
+
 #from xastropy.xutils import xdebug as xdb
 
 # Begin
 def _ftau_intgrnd(x,tau0=0.1):
     return 1 - np.exp(-tau0 * np.exp(-x**2))
 
-# Generate Ftau (could archive, but this is reasonably fast)
+def _ftau0_quad(tau0):
+    """F(tau0) by adaptive quadrature.
+
+    Slow reference implementation, kept to validate the tabulated
+    fixed-node values; not used in any fitting path.
+    """
+    from scipy import integrate
+    Ftau0, _ = integrate.quad(_ftau_intgrnd, 0, np.inf, args=(tau0,))
+    return Ftau0
+
+# The Ftau grid
 neval = 10000
 lgt = np.linspace(-3, 9, neval)
 all_tau0 = 10.**lgt
-#
-xFtau0 = np.zeros(neval)
-for jj,tau0 in enumerate(all_tau0):
-    xFtau0[jj], ferr = integrate.quad(_ftau_intgrnd, 0, np.inf, args=(tau0,))
+
+def _build_ftau_table():
+    """Tabulate F(tau0) on the all_tau0 grid.
+
+    Evaluates the integral on fixed Gauss-Legendre nodes, broadcasting
+    over all tau0 values at once.  The integrand is negligible beyond
+    x=8 for any tau0 in the table (it decays as tau0*exp(-x**2)), so
+    truncating the infinite range there is accurate to ~1e-10.
+    """
+    Nquad = 200
+    xmax = 8.
+    xq, wq = np.polynomial.legendre.leggauss(Nquad)
+    xq = 0.5*xmax*(xq + 1.)
+    wq = 0.5*xmax*wq
+    return wq @ _ftau_intgrnd(xq[:, None], all_tau0[None, :])
+
+# The table only depends on the grid above, so a copy is shipped with
+# the package; recompute (and recache, best-effort) if it is missing
+# or does not match the grid.
+_ftau_table_file = resource_filename('linetools', 'data/cog_Ftau_table.npy')
+xFtau0 = None
+if os.path.isfile(_ftau_table_file):
+    xFtau0 = np.load(_ftau_table_file)
+    if xFtau0.shape != (neval,):
+        xFtau0 = None
+if xFtau0 is None:
+    xFtau0 = _build_ftau_table()
+    try:
+        np.save(_ftau_table_file, xFtau0)
+    except OSError:
+        pass
+
+# Constants of the COG model: tau0 = _TAU0_COEFF * wrest*f * N / b
+# (wrest*f in Ang, b in km/s) and redEW = _REDEW_COEFF * b * F(tau0)
+_TAU0_COEFF = 1.497e-15
+_LOG_TAU0_COEFF = np.log10(_TAU0_COEFF)
+_REDEW_COEFF = 2. / 3e5
+_INV_DLGT = 1. / (lgt[1] - lgt[0])
 
 # Now interpolate
-intFtau0 = interp1d(all_tau0, xFtau0, bounds_error=False,fill_value=0.)
+def intFtau0(tau0):
+    """Linearly interpolate F(tau0) from the precomputed table."""
+    return np.interp(tau0, all_tau0, xFtau0, left=0., right=xFtau0[-1])
+
+
+def _evaluate_cog(wrestf, logN, b):
+    """Reduced EWs for a COG model, in one pass over the line list.
+
+    Parameters
+    ----------
+    wrestf : ndarray
+      wrest*f values (Ang)
+    logN : float
+      log10 column density
+    b : float
+      Doppler parameter (km/s)
+    """
+    # Interpolate on the log10(tau0) axis: the table is uniform there,
+    # so accuracy is even across its 12-decade span and no 10**logN
+    # blow-up is needed.
+    log_tau0 = np.log10(wrestf) + (_LOG_TAU0_COEFF + logN - np.log10(b))
+    # the lgt grid is uniform, so the bracketing table index follows
+    # directly from the coordinate -- no binary search needed
+    x = (log_tau0 - lgt[0]) * _INV_DLGT
+    i = np.clip(x.astype(np.intp), 0, neval - 2)
+    frac = np.clip(x - i, 0., 1.)
+    Ftau0 = xFtau0[i]*(1. - frac) + xFtau0[i+1]*frac
+    # below the table F(tau0) -> 0, as with the old fill value
+    Ftau0[x < 0.] = 0.
+    # reuse the interpolation output buffer for the reduced EWs
+    return np.multiply(Ftau0, _REDEW_COEFF * b, out=Ftau0)
 
 ##############################
 def cog_plot(COG_dict):
@@ -61,9 +134,9 @@ def cog_plot(COG_dict):
     # Model
     xval = np.log10(COG_dict['f']*COG_dict['wrest'].to('cm').value)
     xmod = np.linspace(np.min(xval), np.max(xval), 200)
-    tau0 = 1.497e-15*(10**(xmod+8))*(10.**COG_dict['logN'])/COG_dict['b'].to('km/s').value
+    tau0 = _TAU0_COEFF*(10**(xmod+8))*(10.**COG_dict['logN'])/COG_dict['b'].to('km/s').value
     Ftau0 = intFtau0(tau0)
-    ymod = np.log10(2*COG_dict['b'].to('km/s').value*Ftau0/3e5)
+    ymod = np.log10(_REDEW_COEFF*COG_dict['b'].to('km/s').value*Ftau0)
     #pdb.set_trace()
     ax.plot(xmod,ymod,'g--')
     # Axes
@@ -114,7 +187,7 @@ def single_cog_analysis(wrest, f, EW, sig_EW=None, guesses=None):
     # COG model
     cog_model = single_cog_model(logN=logN, b=b)
     # Fitter
-    fitter = fitting.LevMarLSQFitter()
+    fitter = fitting.TRFLSQFitter(calc_uncertainties=True)
     # Fit
     parm = fitter(cog_model, wrest.to('AA').value*f, redEW, weights=weights)
     # Error
@@ -131,6 +204,85 @@ def single_cog_analysis(wrest, f, EW, sig_EW=None, guesses=None):
     # Return
     return COG_dict
 
+def multi_cog_analysis(wrest_list, f_list, EW_list, sig_EW_list=None,
+                       guesses=None):
+    """Perform COG analysis on several components with a single fit.
+
+    All components are stacked into one least-squares problem (the
+    parameter vector holds every logN and b), so the F(tau0) table is
+    queried once per iteration for all lines and the fitter setup cost
+    is paid once instead of once per component.
+
+    Parameters
+    ----------
+    wrest_list : list of Quantity array
+      Rest wavelengths, one array per component
+    f_list : list of float array
+      f-values, one array per component
+    EW_list : list of Quantity array
+      Measured EWs, one array per component
+    sig_EW_list : list of Quantity array, optional
+      Measured sig_EWs, one array per component
+    guesses : list of tuple of float,float, optional
+      Guesses for (logN, b) of each component
+
+    Returns
+    -------
+    COG_dicts : list of dict
+      One dict per component with the same entries as returned by
+      single_cog_analysis
+    """
+    from scipy.optimize import least_squares
+    ncomp = len(wrest_list)
+    if guesses is None:
+        guesses = [(14., 10.)]*ncomp
+    # Stack the components into flat arrays with a per-line component
+    # index
+    comp_idx = np.concatenate([kk*np.ones(len(wrest), dtype=int)
+                               for kk, wrest in enumerate(wrest_list)])
+    wrestf = np.concatenate([wrest.to('AA').value*f
+                             for wrest, f in zip(wrest_list, f_list)])
+    redEW = np.concatenate([(EW/wrest).value
+                            for wrest, EW in zip(wrest_list, EW_list)])
+    if sig_EW_list is not None:
+        weights = np.concatenate(
+            [((wrest/sig_EW)**2).value
+             for wrest, sig_EW in zip(wrest_list, sig_EW_list)])
+    else:
+        weights = np.ones(len(wrestf))
+
+    # Parameter vector is [logN_0, ..., logN_ncomp-1, b_0, ..., b_ncomp-1]
+    p0 = np.concatenate([[gg[0] for gg in guesses],
+                         [gg[1] for gg in guesses]])
+    bounds = (np.concatenate([np.full(ncomp, 10.), np.full(ncomp, 0.1)]),
+              np.concatenate([np.full(ncomp, 22.), np.full(ncomp, 500.)]))
+
+    def _resid(parm):
+        model = _evaluate_cog(wrestf, parm[:ncomp][comp_idx],
+                              parm[ncomp:][comp_idx])
+        return weights*(model - redEW)
+
+    res = least_squares(_resid, p0, method='trf', bounds=bounds)
+    # Error, following the usual residual-variance scaling of the
+    # inverse curvature matrix
+    dof = max(len(wrestf) - 2*ncomp, 1)
+    covar = np.linalg.pinv(res.jac.T @ res.jac) * 2*res.cost/dof
+    sigma = np.sqrt(np.diag(covar))
+
+    # Generate one COG dict per component
+    COG_dicts = []
+    for kk in range(ncomp):
+        COG_dict = dict(wrest=wrest_list[kk], f=f_list[kk], EW=EW_list[kk],
+                        sig_EW=None if sig_EW_list is None else sig_EW_list[kk],
+                        redEW=redEW[comp_idx == kk],
+                        logN=res.x[kk], sig_logN=sigma[kk],
+                        b=res.x[ncomp+kk]*u.km/u.s,
+                        sig_b=sigma[ncomp+kk]*u.km/u.s)
+        COG_dicts.append(COG_dict)
+    # Return
+    return COG_dicts
+
+
 class single_cog_model(FittableModel):
     """Generate a single COG model
 
@@ -147,16 +299,11 @@ class single_cog_model(FittableModel):
     outputs = ('redEW',)
 
     # Free parameters (generally)
-    logN=Parameter()
-    b=Parameter()  # Assumes km/s
+    logN=Parameter(bounds=(10., 22.))
+    b=Parameter(bounds=(0.1, 500.))  # Assumes km/s
 
     # Fixed parameters
 
     @staticmethod
     def evaluate(wrestf,logN,b):
-        # F(tau0)
-        tau0 = 1.497e-15*(wrestf)*(10.**logN)/b
-        Ftau0 = intFtau0(tau0)
-        # Finish
-        redEW = 2*b*Ftau0/3e5
-        return redEW
+        return _evaluate_cog(wrestf, logN, b)
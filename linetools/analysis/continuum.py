@@ -58,8 +58,13 @@ def make_chunks_qso(wa, redshift, divmult=1, forest_divmult=1, debug=False):
     div.right *= zp1
     if debug:
         print(div.tolist())
-    temp = [np.linspace(left, right, n+1)[:-1] for left,right,n in div]
-    edges = np.concatenate(temp)
+    # one linear ramp per division, built in a single pass: for each
+    # division this reproduces np.linspace(left, right, n+1)[:-1]
+    num = div.num.astype(int)
+    offsets = np.repeat(div.left, num)
+    steps = np.repeat((div.right - div.left) / num, num)
+    k = np.arange(num.sum()) - np.repeat(np.concatenate(([0], np.cumsum(num)[:-1])), num)
+    edges = offsets + k*steps
 
     i0,i1,i2 = edges.searchsorted([wa[0], 1210*zp1, wa[-1]])
     if debug:
@@ -67,93 +72,127 @@ def make_chunks_qso(wa, redshift, divmult=1, forest_divmult=1, debug=False):
     return edges[i0:i2]
 
 
-def update_knots(knots, indices, fl, masked):
+def _median(vals):
+    """ Median of a 1-d array via np.partition.
+
+    Matches np.median for non-empty input, including NaN propagation,
+    with less per-call overhead; this matters when taking medians of
+    many small chunks.
+    """
+    n = len(vals)
+    half = n // 2
+    part = np.partition(vals, (half, n - 1))
+    # partitioning sorts NaNs to the end; propagate them like
+    # np.median does
+    if np.isnan(part[-1]):
+        return np.nan
+    if n % 2 == 1:
+        return part[half]
+    return 0.5 * (part[half] + part[:half].max())
+
+
+def update_knots(knot_y, knot_flag, indices, fl, good, iknots=None):
     """ Calculate the y position of each knot.
 
-    Updates `knots` inplace.
+    Updates `knot_y` inplace.
 
     Parameters
     ----------
-    knots: list of [xpos, ypos, bool] with length N
-      bool says whether the knot should kept unchanged.
-    indices: list of (i0,i1) index pairs
-       The start and end indices into fl and masked of each
-       spectrum chunk (xpos of each knot are the chunk centres).
-    fl, masked: arrays shape (M,)
-       The flux, and boolean arrays showing which pixels are
-       masked.
+    knot_y: array of float, shape (N,)
+       The y position of each knot.
+    knot_flag: array of bool, shape (N,)
+       True means the knot should be kept unchanged.
+    indices: int array of shape (N, 2)
+       The start and end indices into fl and good of each
+       spectrum chunk (x positions of the knots are the chunk centres).
+    fl, good: arrays shape (M,)
+       The flux, and a boolean array which is True at the unmasked
+       pixels.
+    iknots: array of int, optional
+       Only update these knots (default is to update all of them).
     """
 
-    iy, iflag = 1, 2
-    for iknot,(i1,i2) in enumerate(indices):
-        if knots[iknot][iflag]:
+    if iknots is None:
+        iknots = range(len(indices))
+    for iknot in iknots:
+        if knot_flag[iknot]:
             continue
 
-        f0 = fl[i1:i2]
-        m0 = masked[i1:i2]
-        f1 = f0[~m0]
-        knots[iknot][iy] = np.median(f1)
+        i1,i2 = indices[iknot]
+        f1 = fl[i1:i2][good[i1:i2]]
+        knot_y[iknot] = _median(f1)
 
 
-def linear_co(wa, knots):
+def linear_co(wa, knot_x, knot_y):
     """linear interpolation through the spline knots.
 
     Add extra points on either end to give
     a nice slope at the end points."""
-    wavc, mfl = list(zip(*knots))[:2]
-    extwavc = ([wavc[0] - (wavc[1] - wavc[0])] + list(wavc) +
-               [wavc[-1] + (wavc[-1] - wavc[-2])])
-    extmfl = ([mfl[0] - (mfl[1] - mfl[0])] + list(mfl) +
-              [mfl[-1] + (mfl[-1] - mfl[-2])])
+    n = len(knot_x)
+    extwavc = np.empty(n + 2)
+    extwavc[1:-1] = knot_x
+    extwavc[0] = 2*knot_x[0] - knot_x[1]
+    extwavc[-1] = 2*knot_x[-1] - knot_x[-2]
+    extmfl = np.empty(n + 2)
+    extmfl[1:-1] = knot_y
+    extmfl[0] = 2*knot_y[0] - knot_y[1]
+    extmfl[-1] = 2*knot_y[-1] - knot_y[-2]
     co = np.interp(wa, extwavc, extmfl)
     return co
 
 
-def Akima_co(wa, knots):
+def Akima_co(wa, knot_x, knot_y):
     """Akima interpolation through the spline knots."""
-    x,y,_ = zip(*knots)
-    spl = AkimaSpline(x, y)
+    spl = AkimaSpline(knot_x, knot_y)
     return spl(wa)
 
 
-def remove_bad_knots(knots, indices, masked, fl, er, debug=False):
-    """ Remove knots in chunks without any good pixels. Modifies
-    inplace."""
-    idelknot = []
-    for iknot,(i,j) in enumerate(indices):
-        if np.all(masked[i:j]) or np.median(fl[i:j]) <= 2*np.median(er[i:j]):
-            if debug:
-                print('Deleting knot', iknot, 'near {:.1f} Angstroms'.format(
-                    knots[iknot][0]))
-            idelknot.append(iknot)
-
-    for i in reversed(idelknot):
-        del knots[i]
-        del indices[i]
-
-
-def chisq_chunk(model, fl, er, masked, indices, knots, chithresh=1.5):
-    """ Calc chisq per chunk, update knots flags inplace if chisq is
-    acceptable. """
-    chisq = []
-    FLAG = 2
-    for iknot,(i1,i2) in enumerate(indices):
-        if knots[iknot][FLAG]:
-            continue
+def remove_bad_knots(knot_x, indices, masked, fl, er, debug=False):
+    """ Remove knots in chunks without any good pixels.
 
-        f0 = fl[i1:i2]
-        e0 = er[i1:i2]
-        m0 = masked[i1:i2]
-        f1 = f0[~m0]
-        e1 = e0[~m0]
-        mod0 = model[i1:i2]
-        mod1 = mod0[~m0]
-        resid = (mod1 - f1) / e1
-        chisq = np.sum(resid*resid)
-        rchisq = chisq / len(f1)
-        if rchisq < chithresh:
-            #print (good reduced chisq in knot', iknot)
-            knots[iknot][FLAG] = True
+    Returns the filtered `knot_x` and `indices`.
+    """
+    starts, stops = indices[:, 0], indices[:, 1]
+    # count the masked pixels of every chunk in one pass; a chunk is
+    # fully masked when the count matches its length (empty chunks
+    # trivially qualify, matching np.all of an empty slice)
+    cmask = np.concatenate(([0], np.cumsum(masked)))
+    bad = cmask[stops] - cmask[starts] == stops - starts
+    # the medians still need a partition per chunk, but only for the
+    # chunks that survive the cheap all-masked test
+    for iknot in np.flatnonzero(~bad):
+        i, j = indices[iknot]
+        bad[iknot] = _median(fl[i:j]) <= 2*_median(er[i:j])
+
+    idelknot = np.flatnonzero(bad)
+    if debug:
+        for iknot in idelknot:
+            print('Deleting knot', iknot, 'near {:.1f} Angstroms'.format(
+                knot_x[iknot]))
+    if len(idelknot):
+        knot_x = np.delete(knot_x, idelknot)
+        indices = np.delete(indices, idelknot, axis=0)
+    return knot_x, indices
+
+
+def chisq_chunk(model, fl, inv_er, good, indices, knot_flag, chithresh=1.5):
+    """ Calc chisq per chunk, update knot flags inplace if chisq is
+    acceptable.
+
+    `good` is True at the unmasked pixels; `inv_er` is 1/er with zeros
+    at the bad (er <= 0) pixels, which are never good.
+    """
+    # Zero the masked pixels rather than gathering the good ones chunk
+    # by chunk, then use cumulative sums to get per-chunk totals in a
+    # single pass over the arrays.
+    resid2 = np.where(good, ((model - fl) * inv_er)**2, 0.)
+    cresid2 = np.concatenate(([0.], np.cumsum(resid2)))
+    cgood = np.concatenate(([0], np.cumsum(good)))
+    starts, stops = indices[:, 0], indices[:, 1]
+    chunk_chisq = cresid2[stops] - cresid2[starts]
+    ngood = cgood[stops] - cgood[starts]
+    # chisq/ngood < chithresh, without dividing (empty chunks fail)
+    knot_flag[chunk_chisq < chithresh * ngood] = True
 
 
 def prepare_knots(wa, fl, er, edges, ax=None, debug=False):
@@ -170,37 +209,41 @@ def prepare_knots(wa, fl, er, edges, ax=None, debug=False):
 
     Returns
     -------
-    knots, indices, masked
-      * knots: A list of [x, y, flag] lists giving the x and y position
-        of each knot.
-      * indices: A list of tuples (i,j) giving the start and end index
-        of each chunk.
+    knot_x, knot_y, knot_flag, indices, masked
+      * knot_x, knot_y: Arrays giving the x and y position of each
+        knot.
+      * knot_flag: A boolean array, True where a knot should be kept
+        unchanged.
+      * indices: An int array of shape (N, 2) giving the start and end
+        index of each chunk.
       * masked: An array the same shape as wa.
     """
     indices = wa.searchsorted(edges)
-    indices = [(i0,i1) for i0,i1 in zip(indices[:-1],indices[1:])]
-    wavc = [0.5*(w1 + w2) for w1,w2 in zip(edges[:-1],edges[1:])]
-
-    knots = [[wavc[i], 0, False] for i in range(len(wavc))]
+    indices = np.column_stack((indices[:-1], indices[1:]))
+    edges = np.asarray(edges)
+    knot_x = 0.5*(edges[:-1] + edges[1:])
 
     masked = np.zeros(len(wa), bool)
     masked[~(er > 0)] = True
 
     # remove bad knots
-    remove_bad_knots(knots, indices, masked, fl, er, debug=debug)
+    knot_x, indices = remove_bad_knots(knot_x, indices, masked, fl, er,
+                                       debug=debug)
+    knot_y = np.zeros(len(knot_x))
+    knot_flag = np.zeros(len(knot_x), bool)
 
     if ax is not None:
         yedge = np.interp(edges, wa, fl)
         ax.vlines(edges, 0, yedge + 100, color='c', zorder=10)
 
     # set the knot flux values
-    update_knots(knots, indices, fl, masked)
+    update_knots(knot_y, knot_flag, indices, fl, ~masked)
 
     if ax is not None:
-        x,y = list(zip(*knots))[:2]
-        ax.plot(x, y, 'o', mfc='none', mec='c', ms=10, mew=1, zorder=10)
+        ax.plot(knot_x, knot_y, 'o', mfc='none', mec='c', ms=10, mew=1,
+                zorder=10)
 
-    return knots, indices, masked
+    return knot_x, knot_y, knot_flag, indices, masked
 
 
 def unmask(masked, indices, wa, fl, er, minpix=3):
@@ -210,65 +253,92 @@ def unmask(masked, indices, wa, fl, er, minpix=3):
     this! This forces there to be at least minpix pixels used in each
     chunk.
      """
-    for iknot,(i,j) in enumerate(indices):
-        #print(iknot, wa[i], wa[j], (~masked[i:j]).sum())
-        if np.sum(~masked[i:j]) < minpix:
-            #print('unmasking pixels')
-            # need to unmask minpix
-            f0 = fl[i:j]
-            e0 = er[i:j]
-            ind = np.arange(i,j)
-            f1 = f0[e0 > 0]
-            isort = np.argsort(f1)
-            ind1 = ind[e0 > 0][isort[-minpix:]]
-            #    print(wa[i], wa[j])
-            #    print(wa[ind1])
-            masked[ind1] = False
-
-
-def estimate_continuum(s, knots, indices, masked, ax=None, maxiter=100,
-                       nsig=1.5, debug=False):
+    # count the good pixels in every chunk with one pass; only the
+    # (rare) starved chunks need any per-chunk work
+    cgood = np.concatenate(([0], np.cumsum(~masked)))
+    starts, stops = indices[:, 0], indices[:, 1]
+    ngood = cgood[stops] - cgood[starts]
+    for iknot in np.flatnonzero(ngood < minpix):
+        i, j = indices[iknot]
+        #print('unmasking pixels')
+        # need to unmask minpix
+        f0 = fl[i:j]
+        e0 = er[i:j]
+        ind = np.arange(i,j)
+        f1 = f0[e0 > 0]
+        isort = np.argsort(f1)
+        ind1 = ind[e0 > 0][isort[-minpix:]]
+        #    print(wa[i], wa[j])
+        #    print(wa[ind1])
+        masked[ind1] = False
+
+
+def estimate_continuum(wa, fl, er, knot_x, knot_y, knot_flag, indices, masked,
+                       ax=None, maxiter=100, nsig=1.5, debug=False):
     """ Iterate to estimate the continuum.
     """
     count = 0
+    starts, stops = indices[:, 0], indices[:, 1]
+    # loop invariants: 1/er (zeroed at bad pixels, which are always
+    # masked) replaces a division per pixel per iteration
+    inv_er = np.zeros_like(er)
+    np.reciprocal(er, where=er > 0, out=inv_er)
+    # the knot x positions never change inside the loop, so build the
+    # Akima spline once and only refresh its y values each iteration
+    spl = AkimaSpline(knot_x, knot_y)
+    # invert the mask once per iteration (refreshed in place at the
+    # bottom of the loop) instead of once per helper call
+    good = ~masked
+    # Knots whose chunk mask changed since their last update; None
+    # means all of them (first pass).
+    iknots = None
     while True:
         if debug:
             print('iteration', count)
-        update_knots(knots, indices, s.fl, masked)
-        model = linear_co(s.wa, knots)
-        model_a = Akima_co(s.wa, knots)
-        chisq_chunk(model_a, s.fl, s.er, masked,
-                    indices, knots, chithresh=1)
-        flags = list(zip(*knots))[-1]
-        if np.all(flags):
+        update_knots(knot_y, knot_flag, indices, fl, good, iknots=iknots)
+        model = linear_co(wa, knot_x, knot_y)
+        spl.set_yvals(knot_y)
+        model_a = spl(wa)
+        chisq_chunk(model_a, fl, inv_er, good,
+                    indices, knot_flag, chithresh=1)
+        if knot_flag.all():
             if debug:
                 print('All regions have satisfactory fit, stopping')
             break
-        # remove outliers
-        c0 = ~masked
-        resid = (model - s.fl) / s.er
-        oldmasked = masked.copy()
-        masked[(resid > nsig) & ~masked] = True
-        unmask(masked, indices, s.wa, s.fl, s.er)
-        if np.all(oldmasked == masked):
+        # remove outliers; folding the test straight into the mask
+        # (already-masked pixels stay masked) avoids building the
+        # ~masked and fancy-index temporaries
+        masked |= (model - fl) * inv_er > nsig
+        unmask(masked, indices, wa, fl, er)
+        # `good` still holds the complement of the mask from the top
+        # of the iteration, so the entries where it equals the updated
+        # mask are exactly the flipped pixels -- no mask copy needed
+        changed = np.flatnonzero(masked == good)
+        if len(changed) == 0:
             if debug:
                 print('No further points masked, stopping')
             break
+        # only knots whose chunk gained or lost pixels need their
+        # median recomputed on the next pass
+        iknots = starts.searchsorted(changed, side='right') - 1
+        iknots = np.unique(iknots[(iknots >= 0) & (changed < stops[iknots])])
+        np.logical_not(masked, out=good)
         if count > maxiter:
             warnings.warn('Exceeded maximum iterations. Continue at your own risk..')
             break
 
         count +=1
 
-    co = Akima_co(s.wa, knots)
+    spl.set_yvals(knot_y)
+    co = spl(wa)
     c0 = co <= 0
     co[c0] = 0
 
     if ax is not None:
-        ax.plot(s.wa, linear_co(s.wa, knots), color='0.7', lw=2)
-        ax.plot(s.wa, co, 'k', lw=2, zorder=10)
-        x,y = list(zip(*knots))[:2]
-        ax.plot(x, y, 'o', mfc='none', mec='k', ms=10, mew=1, zorder=10)
+        ax.plot(wa, linear_co(wa, knot_x, knot_y), color='0.7', lw=2)
+        ax.plot(wa, co, 'k', lw=2, zorder=10)
+        ax.plot(knot_x, knot_y, 'o', mfc='none', mec='k', ms=10, mew=1,
+                zorder=10)
 
     return co
 
@@ -316,9 +386,9 @@ def find_continuum(spec, edges=None, ax=None, debug=False, kind='QSO',
       continuum from these knots.
     """
 
-    s = np.rec.fromarrays([spec.wavelength.value,
-                           spec.flux.value,
-                           spec.sig], names=str('wa,fl,er'))
+    wa = spec.wavelength.value
+    fl = spec.flux.value
+    er = np.asarray(spec.sig)
 
     if edges is not None:
         edges = list(edges)
@@ -335,27 +405,28 @@ def find_continuum(spec, edges=None, ax=None, debug=False, kind='QSO',
         divmult = kwargs.get('divmult', 2)
         forest_divmult = kwargs.get('forest_divmult', 2)
         edges = make_chunks_qso(
-            s.wa, z, debug=debug, divmult=divmult,
+            wa, z, debug=debug, divmult=divmult,
             forest_divmult=forest_divmult)
     else:
-        s = "Kind keyword {:s} unknown. ".format(kind)
-        s += "Currently only kind='QSO' is supported"
-        raise NotImplementedError(s)
+        msg = "Kind keyword {:s} unknown. ".format(kind)
+        msg += "Currently only kind='QSO' is supported"
+        raise NotImplementedError(msg)
 
 
     if ax is not None:
-        ax.plot(s.wa, s.fl, '-', color='0.4', drawstyle='steps-mid')
-        ax.plot(s.wa, s.er, 'g')
+        ax.plot(wa, fl, '-', color='0.4', drawstyle='steps-mid')
+        ax.plot(wa, er, 'g')
 
-    knots, indices, masked = prepare_knots(s.wa, s.fl, s.er, edges,
-                                           ax=ax, debug=debug)
+    knot_x, knot_y, knot_flag, indices, masked = prepare_knots(
+        wa, fl, er, edges, ax=ax, debug=debug)
 
-    # Note this modifies knots and masked inplace
-    co = estimate_continuum(s, knots, indices, masked, ax=ax, debug=debug)
+    # Note this modifies knot_y, knot_flag and masked inplace
+    co = estimate_continuum(wa, fl, er, knot_x, knot_y, knot_flag, indices,
+                            masked, ax=ax, debug=debug)
 
     if ax is not None:
-        ax.plot(s.wa[~masked], s.fl[~masked], '.y')
-        ymax = np.percentile(s.fl[~np.isnan(s.fl)],  95)
+        ax.plot(wa[~masked], fl[~masked], '.y')
+        ymax = np.percentile(fl[~np.isnan(fl)],  95)
         ax.set_ylim(-0.02*ymax, 1.1*ymax)
 
-    return co, [k[:2] for k in knots]
+    return co, [[x, y] for x, y in zip(knot_x.tolist(), knot_y.tolist())]
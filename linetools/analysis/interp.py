@@ -42,43 +42,67 @@ class AkimaSpline(object):
         y = np.asarray(yvals, dtype=np.float64)
         if x.ndim != 1:
             raise ValueError("x array must be one dimensional")
-     
+
         n = len(x)
         if n < 3:
             raise ValueError("Array too small")
-        if n != len(y):
-            raise ValueError("Size of x-array must match data shape")
-     
+
         dx = np.diff(x)
+        self._isort = None
         if (dx <= 0.0).any():
             isort = np.argsort(x)
             x = x[isort]
-            y = y[isort]
             dx = np.diff(x)
             if (dx == 0.).any():
                 raise ValueError("x array has duplicate values")
+            self._isort = isort
+
+        self.xvals = x
+        self._dx = dx
+        self.set_yvals(y)
+
+    def set_yvals(self, yvals):
+        """ Update the y knot values, keeping the x values fixed.
+
+        This recomputes the spline coefficients without re-checking
+        and re-sorting the x values, so it is cheaper than building a
+        new AkimaSpline when only the y values have changed.
+
+        Parameters
+        ----------
+        yvals : array_like, shape (N,)
+          New y knot values, in the same order as the `xvals` the
+          spline was created with.
+        """
+        y = np.asarray(yvals, dtype=np.float64)
+        x, dx = self.xvals, self._dx
+        n = len(x)
+        if n != len(y):
+            raise ValueError("Size of x-array must match data shape")
+        if self._isort is not None:
+            y = y[self._isort]
 
         m = np.diff(y) / dx
         mm = 2. * m[0] - m[1]
         mmm = 2. * mm - m[0]
         mp = 2. * m[n - 2] - m[n - 3]
         mpp = 2. * mp - m[n - 2]
-     
+
         m1 = np.concatenate(([mmm], [mm], m, [mp], [mpp]))
-     
+
         dm = np.abs(np.diff(m1))
         f1 = dm[2:n + 2]
         f2 = dm[0:n]
         f12 = f1 + f2
-     
+
         ids = np.nonzero(f12 > 1e-9 * f12.max())[0]
         b = m1[1:n + 1]
-     
+
         b[ids] = (f1[ids] * m1[ids + 1] + f2[ids] * m1[ids + 2]) / f12[ids]
         c = (3. * m - 2. * b[0:n - 1] - b[1:n]) / dx
         d = (b[0:n - 1] + b[1:n] - 2. * m) / dx ** 2
 
-        self.xvals, self.yvals, self.b, self.c, self.d = x, y, b, c, d
+        self.yvals, self.b, self.c, self.d = y, b, c, d
 
     def __call__(self, x):
         """
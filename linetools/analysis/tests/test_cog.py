@@ -0,0 +1,49 @@
+# Module to run tests on COG code
+from __future__ import print_function, absolute_import, division, unicode_literals
+
+import numpy as np
+
+from astropy import units as u
+
+from ..cog import _ftau0_quad, intFtau0, single_cog_analysis, \
+    multi_cog_analysis
+
+
+def test_ftau_table():
+    # The tabulated F(tau0) values should match an adaptive quadrature
+    # of the integrand
+    for tau0 in [1e-3, 1., 1e3, 1e9]:
+        assert np.allclose(intFtau0(tau0), _ftau0_quad(tau0), rtol=1e-5)
+
+
+def test_single_cog():
+    # Generate EWs from a known solution and fit them back
+    wrest = np.array([1334.5323, 1036.3367, 1656.9283])*u.AA
+    f = np.array([0.1278, 0.1231, 0.1405])
+    logN, b = 14.5, 12.
+    tau0 = 1.497e-15*(wrest.value*f)*(10.**logN)/b
+    EW = (2*b*intFtau0(tau0)/3e5)*wrest
+    sig_EW = 0.05*EW
+    COG_dict = single_cog_analysis(wrest, f, EW, sig_EW=sig_EW)
+    assert np.isclose(COG_dict['logN'], logN, atol=1e-3)
+    assert np.isclose(COG_dict['b'].to('km/s').value, b, atol=1e-2)
+
+
+def test_multi_cog():
+    # Two components fit in one go
+    wrest = np.array([1334.5323, 1036.3367, 1656.9283])*u.AA
+    f = np.array([0.1278, 0.1231, 0.1405])
+    comps = [(14.5, 12.), (13.2, 25.)]
+    wrest_list, f_list, EW_list, sig_EW_list = [], [], [], []
+    for logN, b in comps:
+        tau0 = 1.497e-15*(wrest.value*f)*(10.**logN)/b
+        EW = (2*b*intFtau0(tau0)/3e5)*wrest
+        wrest_list.append(wrest)
+        f_list.append(f)
+        EW_list.append(EW)
+        sig_EW_list.append(0.05*EW)
+    COG_dicts = multi_cog_analysis(wrest_list, f_list, EW_list,
+                                   sig_EW_list=sig_EW_list)
+    for COG_dict, (logN, b) in zip(COG_dicts, comps):
+        assert np.isclose(COG_dict['logN'], logN, atol=1e-3)
+        assert np.isclose(COG_dict['b'].to('km/s').value, b, atol=1e-2)
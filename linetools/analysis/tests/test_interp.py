@@ -1,9 +1,18 @@
 from __future__ import print_function, absolute_import, division, unicode_literals
 
-from ..interp import interp_Akima
+from ..interp import AkimaSpline, interp_Akima
 import numpy as np
 
 def test_interp_Akima():
     x = np.sort(np.random.random(10) * 10)
     y = np.random.normal(0.0, 0.1, size=len(x))
     assert np.allclose(y, interp_Akima(x, x, y))
+
+def test_AkimaSpline_set_yvals():
+    x = np.sort(np.random.random(10) * 10)
+    y = np.random.normal(0.0, 0.1, size=len(x))
+    y2 = np.random.normal(0.0, 0.1, size=len(x))
+    spl = AkimaSpline(x, y)
+    spl.set_yvals(y2)
+    xnew = np.linspace(x[0], x[-1], 100)
+    assert np.allclose(spl(xnew), AkimaSpline(x, y2)(xnew))
@@ -1438,8 +1438,10 @@ class XSpectrum1D(object):
                 edges = np.linspace(wmin, wmax, np.int(nchunks) + 1)
 
         if knots is None:
-            knots, indices, masked = prepare_knots(
+            knot_x, knot_y, _, indices, masked = prepare_knots(
                 wa, flux, sig, edges)
+            knots = [[x, y] for x, y in zip(knot_x.tolist(),
+                                            knot_y.tolist())]
         else:
             knots = [list(k) for k in knots]
 